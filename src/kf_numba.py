@@ -0,0 +1,97 @@
+"""Numba implementation of the Kalman filter loop, for small latent sizes on CPU
+
+At such sizes a PyTorch step is dominated by dispatch and allocation overhead, so the whole
+sequence loop is compiled into a single function over float64 numpy arrays.
+"""
+
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True, fastmath=True)
+def _matmul(a, b):
+    out = np.zeros((a.shape[0], b.shape[1]))
+    for i in range(a.shape[0]):
+        for k in range(a.shape[1]):
+            aik = a[i, k]
+            for j in range(b.shape[1]):
+                out[i, j] += aik * b[k, j]
+    return out
+
+
+@njit(cache=True)
+def _cholesky_solve(S, rhs):
+    """Solve S X = rhs for a symmetric positive definite S
+
+    Compiled without fastmath, so that a non positive definite S is detected rather than undefined
+    """
+    n = S.shape[0]
+    L = np.zeros((n, n))
+    for j in range(n):
+        d = S[j, j]
+        for k in range(j):
+            d -= L[j, k] * L[j, k]
+        if not d > 0.:
+            raise ValueError("the innovation covariance is not positive definite")
+        L[j, j] = np.sqrt(d)
+        for i in range(j + 1, n):
+            v = S[i, j]
+            for k in range(j):
+                v -= L[i, k] * L[j, k]
+            L[i, j] = v / L[j, j]
+
+    X = rhs.copy()
+    for c in range(X.shape[1]):
+        # forward substitution with L, then backward substitution with L^T
+        for i in range(n):
+            v = X[i, c]
+            for k in range(i):
+                v -= L[i, k] * X[k, c]
+            X[i, c] = v / L[i, i]
+        for i in range(n - 1, -1, -1):
+            v = X[i, c]
+            for k in range(i + 1, n):
+                v -= L[k, i] * X[k, c]
+            X[i, c] = v / L[i, i]
+    return X
+
+
+@njit(cache=True, fastmath=True)
+def project_step(A, B, Q, z, P, u):
+    z_proj = _matmul(A, z) + _matmul(B, u)
+    P_proj = _matmul(A, _matmul(P, A.T)) + Q
+    return z_proj, P_proj
+
+
+@njit(cache=True, fastmath=True)
+def correct_step(C, R, x, z_proj, P_proj):
+    CP = _matmul(C, P_proj)
+    S = _matmul(CP, C.T) + R
+    K = _cholesky_solve(S, CP).T
+    z = z_proj + _matmul(K, x - _matmul(C, z_proj))
+    P = P_proj - _matmul(K, CP)
+    return z, P
+
+
+@njit(cache=True, fastmath=True)
+def kf_inference(A, B, C, Q, R, inputs, controls):
+    """Same as KalmanFilter.inference, for unbatched inputs: [obs_size, seq_len]"""
+    latent_size = A.shape[0]
+    seq_len = inputs.shape[1]
+    zs = np.empty((latent_size, seq_len))
+    pred_xs = np.empty((C.shape[0], seq_len))
+    exs = np.empty((C.shape[0], seq_len))
+
+    # initialize mean and covariance estimates of the latent state
+    z = np.zeros((latent_size, 1))
+    P = np.eye(latent_size)
+    for l in range(seq_len):
+        x = np.ascontiguousarray(inputs[:, l:l + 1])
+        u = np.ascontiguousarray(controls[:, l:l + 1])
+        z_proj, P_proj = project_step(A, B, Q, z, P, u)
+        z, P = correct_step(C, R, x, z_proj, P_proj)
+        pred_x = _matmul(C, z_proj)
+        zs[:, l:l + 1] = z
+        pred_xs[:, l:l + 1] = pred_x
+        exs[:, l:l + 1] = x - pred_x
+    return zs, pred_xs, exs
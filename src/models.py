@@ -1,24 +1,124 @@
-from torch.linalg import inv
+import numpy as np
+import torch.nn.functional as F
+from loguru import logger
+
 from src.utils import *
 
 
+def _nkf_obs_step(z, ez, Wout, x, nonlin):
+    pred_x = torch.mv(Wout, nonlin(z))
+    ex = x - pred_x
+    delta_z = torch.addcmul(ez, nonlin.deriv(z), torch.mv(Wout.t(), ex), value=-1.)
+    return delta_z, ez, pred_x, ex
+
+
+@torch.compile(fullgraph=True, dynamic=False)
+def _nkf_step_static(z, bias, Wout, x, nonlin):
+    """A single inference iteration of NeuralKalmanFilter, compiled so the pointwise ops fuse around the matmuls
+
+    bias: the part of the latent prediction that is fixed within a time step, see NeuralKalmanFilter.bias_term
+    The step size is applied by the caller, so that varying inf_lr does not trigger recompilation.
+    """
+    return _nkf_obs_step(z, z - bias, Wout, x, nonlin)
+
+
+@torch.compile(fullgraph=True, dynamic=False)
+def _nkf_step_dynamic(z, bias, Wr, Wout, x, nonlin):
+    """Same as _nkf_step_static, with the recurrent prediction from the previous *internal* inference step"""
+    return _nkf_obs_step(z, z - bias - torch.mv(Wr, nonlin(z)), Wout, x, nonlin)
+
+
+@torch.compile(mode="reduce-overhead", dynamic=None)
+def _pc_step(z, x, pred_z, Wout_w, nonlin):
+    """A single inference iteration of TemporalPC on raw weight tensors
+
+    pred_z: the forward prediction of the hidden state, which is fixed within a timestep
+    Compiled so the pointwise chain between the matmuls fuses into a few kernels.
+    As in _nkf_step_static, the step size is applied by the caller to avoid recompiling for every inf_lr,
+    and dynamic=None makes the batch size dynamic once a second one is seen, e.g. a final partial batch.
+    """
+    pred_x = F.linear(nonlin(z), Wout_w)
+    err_z = z - pred_z
+    err_x = x - pred_x
+    delta_z = err_z - nonlin.deriv(z) * torch.matmul(err_x, Wout_w)
+    return delta_z, err_x
+
+
+@torch.compile(fullgraph=True, dynamic=None)
+def _inv3x3(S):
+    """Closed-form inverse of (a batch of) 3x3 matrices via the adjugate, compiled into a single pointwise kernel
+
+    dynamic=None recompiles once with a dynamic batch size when a second batch shape is seen,
+    rather than specializing on every batch size.
+    """
+    a, b, c, d, e, f, g, h, i = S.reshape(-1, 9).unbind(-1)
+    A = e * i - f * h
+    B = f * g - d * i
+    C = d * h - e * g
+    det = a * A + b * B + c * C
+    adj = torch.stack([A, c * h - b * i, b * f - c * e,
+                       B, a * i - c * g, c * d - a * f,
+                       C, b * g - a * h, a * e - b * d], -1)
+    return (adj / det.unsqueeze(-1)).reshape(S.shape)
+
+
+def _solve3x3(S, rhs):
+    return torch.matmul(_inv3x3(S), rhs)
+
+
+def _spd_solve(S, rhs, max_batch=65535):
+    """Solve S X = rhs for symmetric positive definite S
+
+    A single S uses the Cholesky factorization. For a batch of S, the batched LU solve of torch.linalg.solve
+    is considerably faster, and the batch is processed in chunks of max_batch, as batched solvers have had
+    problems with batches of 65536 matrices or more.
+    """
+    if S.dim() == 2:
+        return torch.cholesky_solve(rhs, torch.linalg.cholesky(S))
+    batch_shape = S.shape[:-2]
+    S = S.reshape(-1, *S.shape[-2:])
+    rhs = rhs.expand(*batch_shape, *rhs.shape[-2:]).reshape(-1, *rhs.shape[-2:])
+    if S.shape[0] <= max_batch:
+        X = torch.linalg.solve(S, rhs)
+    else:
+        X = torch.cat([torch.linalg.solve(S_chunk, rhs_chunk)
+                       for S_chunk, rhs_chunk in zip(S.split(max_batch), rhs.split(max_batch))])
+    return X.reshape(*batch_shape, *X.shape[-2:])
+
+
+# the CPU fallback of KalmanFilter.inference is logged once per process, not once per filter
+_cpu_fallback_logged = False
+
+
 class KalmanFilter(nn.Module):
     """Kalman filter
 
     x: observation layer
     z: hidden layer
+
+    Parameters and states are kept in float32, inputs of other dtypes are cast on entry
+    cpu_fallback: run inference of small filters and batches on CPU, see inference(). Disable it to keep the
+                  computation on the device of the inputs, e.g. to use the closed-form 3x3 solve on GPU
     """
 
-    def __init__(self, A, B, C, Q, R, latent_size) -> None:
+    dtype = torch.float32
+
+    def __init__(self, A, B, C, Q, R, latent_size, cpu_fallback=True) -> None:
         super().__init__()
-        self.A = A.clone()
-        self.B = B.clone()
-        self.C = C.clone()
+        self.A = A.clone().to(self.dtype)
+        self.B = B.clone().to(self.dtype)
+        self.C = C.clone().to(self.dtype)
         # control input, a list/1d array
         self.latent_size = latent_size
         # covariance matrix of noise
-        self.Q = Q
-        self.R = R
+        self.Q = Q.to(self.dtype)
+        self.R = R.to(self.dtype)
+        # initial mean and covariance estimates of the latent state
+        self.register_buffer('_z_init', torch.zeros((latent_size, 1), dtype=self.dtype), persistent=False)
+        self.register_buffer('_P_init', torch.eye(latent_size, dtype=self.dtype), persistent=False)
+        self._solve = None
+        self._params_to(self.C.device)
+        self.cpu_fallback = cpu_fallback
 
         self.z = None
         self.P = None
@@ -26,43 +126,107 @@ class KalmanFilter(nn.Module):
         self.u = None
         self.exs = None
 
+    def _params_to(self, device):
+        """Move the parameters to device and select the solver for the innovation covariance S there
+
+        On GPU a 3x3 solve is dominated by the launch overhead of the linalg kernels, so it uses
+        the closed-form inverse. On CPU _spd_solve is faster
+        """
+        self.A, self.B, self.C, self.Q, self.R = (p.to(device) for p in (self.A, self.B, self.C, self.Q, self.R))
+        self._z_init, self._P_init = self._z_init.to(device), self._P_init.to(device)
+        self._solve = _solve3x3 if self.C.shape[0] == 3 and self.C.is_cuda else _spd_solve
+
+    def _use_cpu_fallback(self, inputs):
+        """Whether inference on inputs is small enough to run on CPU instead of their device
+
+        The size counts every trajectory of a batch, as a large batch of small filters is
+        not launch-overhead bound.
+        """
+        size = inputs.shape[:-2].numel() * self.latent_size * self.C.shape[0]
+        return self.cpu_fallback and inputs.device.type != 'cpu' and size < 64 * 64
+
     def projection(self):
-        z_proj = torch.matmul(self.A, self.z) + torch.matmul(self.B, self.u)
-        P_proj = torch.matmul(self.A, torch.matmul(self.P, self.A.t())) + self.Q
+        PA = torch.matmul(self.P, self.A.t())
+        if PA.dim() == 2:
+            # fuse the additive terms into the trailing matmul, which benchmarks faster than mm + add here
+            z_proj = torch.addmm(torch.matmul(self.B, self.u), self.A, self.z)
+            P_proj = torch.addmm(self.Q, self.A, PA)
+        else:
+            # addmm has no broadcasting counterpart over arbitrary batch dimensions
+            z_proj = torch.matmul(self.A, self.z) + torch.matmul(self.B, self.u)
+            P_proj = torch.matmul(self.A, PA) + self.Q
         return z_proj, P_proj
 
     def correction(self, z_proj, P_proj):
         """Correction step in KF
 
         K: Kalman gain
+        S: innovation covariance, symmetric positive definite, so K = P_proj C^T S^-1
+           is obtained as (S^-1 C P_proj)^T
         """
-        K = torch.matmul(torch.matmul(P_proj, self.C.t()),
-                         inv(torch.matmul(torch.matmul(self.C, P_proj), self.C.t()) + self.R))
+        CP = torch.matmul(self.C, P_proj)
+        S = torch.matmul(CP, self.C.t()) + self.R
+        K = self._solve(S, CP).transpose(-1, -2)
         self.z = z_proj + torch.matmul(K, self.x - torch.matmul(self.C, z_proj))
-        self.P = P_proj - torch.matmul(K, torch.matmul(self.C, P_proj))
+        self.P = P_proj - torch.matmul(K, CP)
 
     def inference(self, inputs, controls):
-        zs = []
-        pred_xs = []
-        exs = []
-        seq_len = inputs.shape[1]
-        # initialize mean and covariance estimates of the latent state
-        self.z = torch.zeros((self.latent_size, 1)).to(inputs.device)
-        self.P = torch.eye(self.latent_size).to(inputs.device)
+        """inputs: [obs_size, seq_len], or [batch_size, obs_size, seq_len] for independent trajectories
+
+        With a leading batch dimension every step is a single batched matmul and batched solve
+        over all trajectories (see _spd_solve), rather than one filter call per trajectory.
+
+        For small filters and batches the loop runs on CPU, where the tiny matmuls and solves
+        are not dominated by kernel launch overhead, and the outputs are moved back to the device of inputs.
+        This takes precedence over the closed-form 3x3 solve on GPU, unless cpu_fallback is disabled.
+        """
+        global _cpu_fallback_logged
+        out_device = inputs.device
+        if self._use_cpu_fallback(inputs):
+            if not _cpu_fallback_logged:
+                logger.info(f'Small Kalman filter (latent size {self.latent_size}, observation size '
+                            f'{self.C.shape[0]}), running inference on CPU instead of {out_device}')
+                _cpu_fallback_logged = True
+            inputs, controls = inputs.cpu(), controls.cpu()
+        self._params_to(inputs.device)
+
+        inputs, controls = inputs.to(self.dtype), controls.to(self.dtype)
+        seq_len = inputs.shape[-1]
+        batch_shape = inputs.shape[:-2]
+        obs_size = self.C.shape[0]
+        zs = torch.empty((*batch_shape, self.latent_size, seq_len), dtype=self.dtype, device=inputs.device)
+        pred_xs = torch.empty((*batch_shape, obs_size, seq_len), dtype=self.dtype, device=inputs.device)
+        self.exs = torch.empty((*batch_shape, obs_size, seq_len), dtype=self.dtype, device=inputs.device)
+        # initialize mean and covariance estimates of the latent state, both are replaced rather than
+        # updated in place at every step, so views of the cached buffers suffice
+        self.z = self._z_init.expand((*batch_shape, self.latent_size, 1))
+        self.P = self._P_init.expand((*batch_shape, self.latent_size, self.latent_size))
         for l in range(seq_len):
-            self.x = inputs[:, l:l + 1]
-            self.u = controls[:, l:l + 1]
+            self.x = inputs[..., l:l + 1]
+            self.u = controls[..., l:l + 1]
             z_proj, P_proj = self.projection()
             self.correction(z_proj, P_proj)
-            zs.append(self.z.detach().clone())
+            zs[..., l:l + 1] = self.z.detach()
             pred_x = torch.matmul(self.C, z_proj)
-            pred_xs.append(pred_x)
-            exs.append(self.x - pred_x)
-        # collect predictions on the observaiton level
-        pred_xs = torch.cat(pred_xs, dim=1)
-        self.exs = torch.cat(exs, dim=1)
-        zs = torch.cat(zs, dim=1)
-        return zs, pred_xs
+            pred_xs[..., l:l + 1] = pred_x
+            self.exs[..., l:l + 1] = self.x - pred_x
+        self.exs = self.exs.to(out_device)
+        return zs.to(out_device), pred_xs.to(out_device)
+
+    def inference_numba(self, inputs, controls):
+        """Same as inference(), with the sequence loop compiled by numba on CPU
+
+        Meant for small latent sizes, where a PyTorch step is dominated by dispatch overhead.
+        Only unbatched inputs, [obs_size, seq_len], are supported. Computation is in float64.
+        """
+        if inputs.dim() != 2:
+            raise ValueError("inference_numba only supports unbatched inputs of shape [obs_size, seq_len]!")
+        from src.kf_numba import kf_inference
+
+        params = [to_np(p).astype(np.float64) for p in (self.A, self.B, self.C, self.Q, self.R, inputs, controls)]
+        zs, pred_xs, exs = kf_inference(*params)
+        self.exs = to_torch(exs, inputs.device).to(self.dtype)
+        return to_torch(zs, inputs.device).to(self.dtype), to_torch(pred_xs, inputs.device).to(self.dtype)
 
 
 class NeuralKalmanFilter(nn.Module):
@@ -71,17 +235,22 @@ class NeuralKalmanFilter(nn.Module):
     x: observation layer
     z: hidden layer
     A, B, C: initial value of weight parameters. In the case of not learning, they are the correct values
+
+    The states x, z and u of a single time step are kept as 1d vectors, so products with the weights are GEMVs
+    Weights and states are kept in float32, inputs of other dtypes are cast on entry
     """
 
+    dtype = torch.float32
+
     def __init__(self, A, B, C, latent_size, dynamic_inf=False, nonlin='linear') -> None:
         super().__init__()
-        self.Wr = A.clone()
-        self.Win = B.clone()
-        self.Wout = C.clone()
+        self.Wr = A.clone().to(self.dtype)
+        self.Win = B.clone().to(self.dtype)
+        self.Wout = C.clone().to(self.dtype)
 
         # control input, a list/1d array
         self.latent_size = latent_size
-        self.dynamic_inf = dynamic_inf
+        self._dynamic_inf = dynamic_inf
 
         self.ez = None
         self.pred_x = None
@@ -91,6 +260,11 @@ class NeuralKalmanFilter(nn.Module):
         self.prev_z = None
         self.z = None
 
+        # latent state buffers, reset in place at every call
+        self.register_buffer('_z_buf', torch.zeros((latent_size,), dtype=self.dtype), persistent=False)
+        self.register_buffer('_prev_z_buf', torch.zeros((latent_size,), dtype=self.dtype), persistent=False)
+        self.register_buffer('_eye', torch.eye(latent_size, dtype=self.dtype), persistent=False)
+
         if nonlin == 'linear':
             self.nonlin = Linear()
         elif nonlin == 'tanh':
@@ -98,32 +272,56 @@ class NeuralKalmanFilter(nn.Module):
         else:
             raise ValueError("no such nonlinearity!")
 
-    def update_nodes(self, inf_lr):
-        with torch.no_grad():
-            if self.dynamic_inf:
-                # if we use dynamic inference, the prediction is from the previous *internal* inference step
-                self.ez = self.z - torch.matmul(self.Wr, self.nonlin(self.z)) - torch.matmul(self.Win,
-                                                                                             self.nonlin(self.u))
-            else:
-                # or esle, the prediction is from the previous *external* time step
-                self.ez = self.z - torch.matmul(self.Wr, self.nonlin(self.prev_z)) - torch.matmul(self.Win,
-                                                                                                  self.nonlin(self.u))
+        # dynamic_inf is fixed, so pick the specialized inference iteration once
+        self.update_nodes = self._update_nodes_dynamic if dynamic_inf else self._update_nodes_static
+
+    @property
+    def dynamic_inf(self):
+        """Whether inference is dynamic, fixed at construction as update_nodes is specialized on it"""
+        return self._dynamic_inf
+
+    def _init_buffers(self, device):
+        """Initialize z and prev_z with 0, reusing the same buffers across calls"""
+        if self._z_buf.device != device:
+            # the buffers follow .to(device), this only covers inputs on another device than the module
+            self._z_buf = self._z_buf.to(device)
+            self._prev_z_buf = self._prev_z_buf.to(device)
+            self._eye = self._eye.to(device)
+        self.z = self._z_buf.zero_()
+        self.prev_z = self._prev_z_buf.zero_()
+
+    def bias_term(self):
+        """The part of the latent prediction that does not change across inference iterations of a time step
+
+        With dynamic inference, the recurrent prediction is from the previous *internal* inference step
+        and is recomputed in every iteration, so only the control input contributes here.
+        """
+        bias = torch.mv(self.Win, self.nonlin(self.u))
+        if not self.dynamic_inf:
+            # or esle, the prediction is from the previous *external* time step
+            bias = bias + torch.mv(self.Wr, self.nonlin(self.prev_z))
+        return bias
 
+    def _update_nodes_static(self, inf_lr, bias_term):
+        with torch.no_grad():
             # we also need to consider precision here, but for now let's stick with precision=I
-            self.pred_x = torch.matmul(self.Wout, self.nonlin(self.z))
-            self.ex = self.x - self.pred_x
-            delta_z = self.ez - self.nonlin.deriv(self.z) * torch.matmul(self.Wout.t(), self.ex) + 0.0 * torch.sign(
-                self.z)
-            self.z -= inf_lr * delta_z
+            delta_z, self.ez, self.pred_x, self.ex = _nkf_step_static(self.z, bias_term, self.Wout, self.x,
+                                                                       self.nonlin)
+            self.z.sub_(delta_z, alpha=inf_lr)
+
+    def _update_nodes_dynamic(self, inf_lr, bias_term):
+        with torch.no_grad():
+            delta_z, self.ez, self.pred_x, self.ex = _nkf_step_dynamic(self.z, bias_term, self.Wr, self.Wout,
+                                                                        self.x, self.nonlin)
+            self.z.sub_(delta_z, alpha=inf_lr)
 
     def update_transition(self, learn_lr):
-        delta_Wr = torch.matmul(self.ez, self.nonlin(self.prev_z).t())
-        self.Wr += learn_lr * delta_Wr
+        # Wr += learn_lr * outer(ez, nonlin(prev_z)), without materializing the outer product
+        self.Wr.addr_(self.ez, self.nonlin(self.prev_z), alpha=learn_lr)
 
     def update_emission(self, learn_lr):
         # learn the emission matrix
-        delta_Wout = torch.matmul(self.ex, self.nonlin(self.z).t())
-        self.Wout += learn_lr * delta_Wout
+        self.Wout.addr_(self.ex, self.nonlin(self.z), alpha=learn_lr)
 
     def predict(self, inputs, controls, inf_iters, inf_lr):
         """Given weigth matrices A and C, this function estimates the latent and observed activities
@@ -134,53 +332,62 @@ class NeuralKalmanFilter(nn.Module):
             - Totally random
         """
 
-        zs = []  # inferred latent states
-        z_projs = []  # projected latent states
+        inputs, controls = inputs.to(self.dtype), controls.to(self.dtype)
         seq_len = inputs.shape[1]
-
-        # initialize the latent states with 0
-        self.z = torch.zeros((self.latent_size, 1)).to(inputs.device)
+        # inferred and projected latent states, filled one row per time step and transposed once at the end
+        zs = torch.empty((seq_len, self.latent_size), dtype=self.dtype, device=inputs.device)
+        z_projs = torch.empty((seq_len, self.latent_size), dtype=self.dtype, device=inputs.device)
+
+        # initialize the latent states with 0, z and prev_z are two buffers swapped at every time step
+        self._init_buffers(inputs.device)
+        if inf_iters == 0:
+            # the equilibrium matrix I + Wout^T Wout is fixed across time steps, so factorize it only once
+            M = self._eye + torch.matmul(self.Wout.t(), self.Wout)
+            L = torch.linalg.cholesky(M)
         for l in range(seq_len):
-            self.x = inputs[:, l:l + 1]
-            self.u = controls[:, l:l + 1]
-            self.prev_z = self.z.clone()
-            z_projs.append(torch.matmul(self.Wr, self.nonlin(self.z)) + torch.matmul(self.Win, self.nonlin(self.u)))
+            self.x = inputs[:, l]
+            self.u = controls[:, l]
+            self.prev_z, self.z = self.z, self.prev_z
+            self.z.copy_(self.prev_z)
+            z_proj = torch.mv(self.Wr, self.nonlin(self.prev_z)) + torch.mv(self.Win, self.nonlin(self.u))
+            z_projs[l] = z_proj
 
             # perform inference
             if inf_iters == 0:
                 # equilibrium of PC inference, only applies to linear case
-                temp1 = torch.linalg.inv(torch.eye(self.latent_size) + torch.matmul(self.Wout.t(), self.Wout))
-                temp2 = torch.matmul(self.Wout.t(), self.x) + torch.matmul(self.Wr, self.prev_z) + torch.matmul(
-                    self.Win, self.u)
-                self.z = torch.matmul(temp1, temp2)
+                temp2 = torch.mv(self.Wout.t(), self.x) + torch.mv(self.Wr, self.prev_z) + torch.mv(self.Win, self.u)
+                self.z.copy_(torch.cholesky_solve(temp2.unsqueeze(-1), L).squeeze(-1))
             else:
-                # perform inference iteratively
+                # perform inference iteratively, without dynamic inference the projection is exactly the bias term
+                bias_term = self.bias_term() if self.dynamic_inf else z_proj
                 for itr in range(inf_iters):
-                    self.update_nodes(inf_lr)
+                    self.update_nodes(inf_lr, bias_term)
 
-            zs.append(self.z.detach().clone())
+            zs[l] = self.z.detach()
 
-        zs = torch.cat(zs, dim=1)
-        z_projs = torch.cat(z_projs, dim=1)
+        zs = zs.t()
         # make prediction of the observations by a forward pass
-        pred_xs = torch.matmul(self.Wout, self.nonlin(z_projs))
+        pred_xs = torch.matmul(self.Wout, self.nonlin(z_projs.t()))
         return zs, pred_xs
 
     def train(self, inputs, controls, inf_iters, inf_lr, learn_iters=1, learn_lr=2e-4):
         """Learn the model weigths A and C"""
+        inputs, controls = inputs.to(self.dtype), controls.to(self.dtype)
         seq_len = inputs.shape[1]
 
-        # initialize the latent states with 0
+        # initialize the latent states with 0, z and prev_z are two buffers swapped at every time step
         for i in range(learn_iters):
-            self.z = torch.zeros((self.latent_size, 1)).to(inputs.device)
+            self._init_buffers(inputs.device)
             for l in range(seq_len):
-                self.x = inputs[:, l:l + 1]
-                self.u = controls[:, l:l + 1]
-                self.prev_z = self.z.clone()
+                self.x = inputs[:, l]
+                self.u = controls[:, l]
+                self.prev_z, self.z = self.z, self.prev_z
+                self.z.copy_(self.prev_z)
 
                 # perform inference iteratively
+                bias_term = self.bias_term()
                 for itr in range(inf_iters):
-                    self.update_nodes(inf_lr)
+                    self.update_nodes(inf_lr, bias_term)
 
                 # update the transition after inference converges
                 self.update_transition(learn_lr)
@@ -213,8 +420,9 @@ class TemporalPC(nn.Module):
             raise ValueError("no such nonlinearity!")
 
     def forward(self, u, prev_z):
-        pred_z = self.Win(self.nonlin(u)) + self.Wr(self.nonlin(prev_z))
-        pred_x = self.Wout(self.nonlin(pred_z))
+        # use the weights directly rather than going through the nn.Linear module calls
+        pred_z = F.linear(self.nonlin(u), self.Win.weight) + F.linear(self.nonlin(prev_z), self.Wr.weight)
+        pred_x = F.linear(self.nonlin(pred_z), self.Wout.weight)
         return pred_z, pred_x
 
     def init_hidden(self, bsz):
@@ -223,18 +431,21 @@ class TemporalPC(nn.Module):
 
     def update_errs(self, x, u, prev_z):
         pred_z, _ = self.forward(u, prev_z)
-        pred_x = self.Wout(self.nonlin(self.z))
+        pred_x = F.linear(self.nonlin(self.z), self.Wout.weight)
         err_z = self.z - pred_z
         err_x = x - pred_x
         return err_z, err_x
 
     def update_nodes(self, x, u, prev_z, inf_lr, update_x=False):
-        err_z, err_x = self.update_errs(x, u, prev_z)
-        delta_z = err_z - self.nonlin.deriv(self.z) * torch.matmul(err_x, self.Wout.weight.detach().clone())
-        self.z -= inf_lr * delta_z
+        pred_z, _ = self.forward(u, prev_z)
+        self._update_nodes(x, pred_z, inf_lr, update_x)
+
+    def _update_nodes(self, x, pred_z, inf_lr, update_x=False):
+        delta_z, err_x = _pc_step(self.z, x, pred_z, self.Wout.weight, self.nonlin)
+        self.z.sub_(delta_z, alpha=inf_lr)
         if update_x:
             delta_x = err_x
-            x -= inf_lr * delta_x
+            x.sub_(delta_x, alpha=inf_lr)
 
     def inference(self, inf_iters, inf_lr, x, u, prev_z, update_x=False):
         """prev_z should be set up outside the inference, from the previous timestep
@@ -245,12 +456,40 @@ class TemporalPC(nn.Module):
         After every time step, we change prev_z to self.z
         """
         with torch.no_grad():
-            # initialize the current hidden state with a forward pass
-            self.z, _ = self.forward(u, prev_z)
+            pred_z, _ = self.forward(u, prev_z)
+            self._inference_step(inf_iters, inf_lr, x, pred_z, update_x)
+
+    def _inference_step(self, inf_iters, inf_lr, x, pred_z, update_x=False):
+        # initialize the current hidden state with the forward prediction, which stays fixed during inference
+        self.z = pred_z.clone()
+
+        # update the values nodes
+        for i in range(inf_iters):
+            self._update_nodes(x, pred_z, inf_lr, update_x)
+
+    def inference_seq(self, inf_iters, inf_lr, xs, us, prev_z, update_x=False):
+        """Run inference over a whole sequence in a single call
 
-            # update the values nodes
-            for i in range(inf_iters):
-                self.update_nodes(x, u, prev_z, inf_lr, update_x)
+        xs: [batch_size, seq_len, output_size]
+        us: [batch_size, seq_len, control_size]
+        prev_z: hidden state before the first timestep, e.g. from init_hidden
+
+        The batch is processed at once, and prev_z is set to self.z after every timestep.
+        The control term Win nonlin(u) is computed for the whole sequence in one matmul, and the forward
+        prediction of each timestep once rather than in every inference iteration.
+        With update_x=True, xs is updated in place, as x is in inference().
+        Returns the inferred hidden states, [batch_size, seq_len, hidden_size]
+        """
+        seq_len = xs.shape[1]
+        zs = torch.empty((xs.shape[0], seq_len, self.hidden_size), dtype=xs.dtype, device=xs.device)
+        with torch.no_grad():
+            Win_us = F.linear(self.nonlin(us), self.Win.weight)
+            for t in range(seq_len):
+                pred_z = Win_us[:, t] + F.linear(self.nonlin(prev_z), self.Wr.weight)
+                self._inference_step(inf_iters, inf_lr, xs[:, t], pred_z, update_x)
+                zs[:, t] = self.z
+                prev_z = self.z
+        return zs
 
     def update_grads(self, x, u, prev_z):
         """x: input at a particular timestep in stimulus
@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+import torch
+
+from src.models import KalmanFilter, TemporalPC, _inv3x3, _spd_solve
+
+
+def _random_system(latent_size=3, obs_size=3, seed=0):
+    g = torch.Generator()
+    g.manual_seed(seed)
+    A = torch.eye(latent_size) * 0.9 + 0.05 * torch.randn((latent_size, latent_size), generator=g)
+    B = torch.randn((latent_size, 1), generator=g)
+    C = torch.randn((obs_size, latent_size), generator=g)
+    Q = torch.eye(latent_size)
+    R = torch.eye(obs_size)
+    return A, B, C, Q, R
+
+
+def test_inference_numba_matches_inference():
+    pytest.importorskip('numba')
+    A, B, C, Q, R = _random_system()
+    g = torch.Generator()
+    g.manual_seed(1)
+    xs = torch.randn((3, 100), generator=g)
+    us = torch.randn((1, 100), generator=g)
+
+    kf = KalmanFilter(A, B, C, Q, R, latent_size=3)
+    zs, pred_xs = kf.inference(xs, us)
+    exs = kf.exs
+    zs_nb, pred_xs_nb = kf.inference_numba(xs, us)
+
+    np.testing.assert_allclose(zs_nb.numpy(), zs.numpy(), atol=1e-4)
+    np.testing.assert_allclose(pred_xs_nb.numpy(), pred_xs.numpy(), atol=1e-4)
+    np.testing.assert_allclose(kf.exs.numpy(), exs.numpy(), atol=1e-4)
+
+
+def test_inference_numba_rejects_batched_inputs():
+    A, B, C, Q, R = _random_system()
+    kf = KalmanFilter(A, B, C, Q, R, latent_size=3)
+    with pytest.raises(ValueError):
+        kf.inference_numba(torch.randn((2, 3, 5)), torch.randn((2, 1, 5)))
+
+
+def test_inference_numba_rejects_non_positive_definite_covariance():
+    pytest.importorskip('numba')
+    A, B, C, Q, R = _random_system()
+    kf = KalmanFilter(A, B, C, Q, -10 * R, latent_size=3)
+    with pytest.raises(ValueError):
+        kf.inference_numba(torch.randn((3, 5)), torch.randn((1, 5)))
+
+
+@pytest.mark.parametrize('batch_shape', [(), (1,), (5,), (7,), (2, 4)])
+def test_inv3x3_matches_linalg_inv(batch_shape):
+    g = torch.Generator()
+    g.manual_seed(2)
+    M = torch.randn((*batch_shape, 3, 3), generator=g)
+    S = M @ M.transpose(-1, -2) + torch.eye(3)
+    np.testing.assert_allclose(_inv3x3(S).numpy(), torch.linalg.inv(S).numpy(), atol=1e-5)
+
+
+@pytest.mark.parametrize('batched_controls', [True, False])
+def test_batched_inference_matches_per_trajectory(batched_controls):
+    A, B, C, Q, R = _random_system()
+    g = torch.Generator()
+    g.manual_seed(3)
+    xs = torch.randn((4, 3, 50), generator=g)
+    us = torch.randn((4, 1, 50), generator=g) if batched_controls else torch.randn((1, 50), generator=g)
+
+    kf = KalmanFilter(A, B, C, Q, R, latent_size=3)
+    zs, pred_xs = kf.inference(xs, us)
+    assert zs.shape == (4, 3, 50)
+    for i in range(xs.shape[0]):
+        zs_i, pred_xs_i = kf.inference(xs[i], us[i] if batched_controls else us)
+        np.testing.assert_allclose(zs[i].numpy(), zs_i.numpy(), atol=1e-5)
+        np.testing.assert_allclose(pred_xs[i].numpy(), pred_xs_i.numpy(), atol=1e-5)
+
+
+@pytest.mark.parametrize('update_x', [False, True])
+def test_inference_seq_matches_stepwise_inference(update_x):
+    torch.manual_seed(4)
+    model = TemporalPC(control_size=4, hidden_size=8, output_size=5)
+    xs = torch.randn((3, 6, 5))
+    us = torch.randn((3, 6, 4))
+    z0 = torch.randn((3, 8))
+
+    xs_seq = xs.clone()
+    zs = model.inference_seq(10, 0.1, xs_seq, us, z0, update_x=update_x)
+
+    xs_step = xs.clone()
+    prev_z = z0
+    for t in range(xs.shape[1]):
+        model.inference(10, 0.1, xs_step[:, t], us[:, t], prev_z, update_x=update_x)
+        np.testing.assert_allclose(zs[:, t].numpy(), model.z.numpy(), atol=1e-5)
+        prev_z = model.z
+
+    # with update_x, xs is inferred in place as in inference()
+    np.testing.assert_allclose(xs_seq.numpy(), xs_step.numpy(), atol=1e-5)
+    assert update_x != torch.allclose(xs_seq, xs)
+
+
+def test_cpu_fallback_only_for_small_inputs():
+    A, B, C, Q, R = _random_system()
+    kf = KalmanFilter(A, B, C, Q, R, latent_size=3)
+    # meta tensors stand in for inputs on a non-CPU device
+    assert kf._use_cpu_fallback(torch.empty((3, 10), device='meta'))
+    assert kf._use_cpu_fallback(torch.empty((4, 3, 10), device='meta'))
+    assert not kf._use_cpu_fallback(torch.empty((65536, 3, 10), device='meta'))
+    assert not kf._use_cpu_fallback(torch.empty((3, 10)))
+
+    kf = KalmanFilter(A, B, C, Q, R, latent_size=3, cpu_fallback=False)
+    assert not kf._use_cpu_fallback(torch.empty((3, 10), device='meta'))
+
+
+def test_spd_solve_chunks_large_batches():
+    g = torch.Generator()
+    g.manual_seed(5)
+    M = torch.randn((2, 7, 3, 3), generator=g)
+    S = M @ M.transpose(-1, -2) + torch.eye(3)
+    rhs = torch.randn((2, 7, 3, 3), generator=g)
+    np.testing.assert_allclose(_spd_solve(S, rhs, max_batch=3).numpy(), torch.linalg.solve(S, rhs).numpy(),
+                               atol=1e-6)